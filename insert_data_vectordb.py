@@ -1,7 +1,10 @@
 from dotenv import load_dotenv
 from openai import OpenAI
 import psycopg2
-import json
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
+import numpy as np
+import orjson
 import os
 load_dotenv()
 
@@ -15,9 +18,36 @@ DB_NAME = os.getenv("DB_NAME", "movies_db")
 DB_USER = os.getenv("DB_USER", "manishsingh")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "manish123")
 
-EMBEDDING_DIM = 1536
-
-def create_table_and_insert_data(json_file_path: str, batch_size: int = 20):
+# text-embedding-3-small truncated to 512 dimensions (Matryoshka), a third of
+# the size of the 1536-d ada-002 vectors. Re-run insert_data_vectordb.py after
+# changing either value so the stored vectors match.
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 512
+
+INSERT_SQL = """
+INSERT INTO movie_embeddings
+    (movie_id, title, year, genres, plot_summary, actors, embedding)
+VALUES %s;
+"""
+
+def insert_batch(conn, cur, batch, movie_texts):
+    """Embed a batch of movies with one API call and insert them in one statement."""
+    try:
+        response = client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=movie_texts,
+            dimensions=EMBEDDING_DIM
+        )
+        values = [movie + (np.asarray(item.embedding, dtype=np.float32),)
+                  for movie, item in zip(batch, response.data)]
+        execute_values(cur, INSERT_SQL, values, page_size=len(values))
+        conn.commit()
+        print(f"Inserted {len(batch)} movies into movie_embeddings table")
+    except Exception as e:
+        print(f"Error inserting batch: {e}")
+        conn.rollback()
+
+def create_table_and_insert_data(json_file_path: str, batch_size: int = 256):
 
     conn=psycopg2.connect(
         host=DB_HOST,
@@ -33,6 +63,7 @@ def create_table_and_insert_data(json_file_path: str, batch_size: int = 20):
     # Drop existing table if it exists
     cur.execute("DROP TABLE IF EXISTS movie_embeddings;")
     conn.commit()
+    register_vector(conn)
 
     # Create fresh table
     create_table_sql = f"""
@@ -44,56 +75,68 @@ def create_table_and_insert_data(json_file_path: str, batch_size: int = 20):
         genres TEXT,
         plot_summary TEXT,
         actors TEXT,
-        embedding vector({EMBEDDING_DIM})
+        embedding vector({EMBEDDING_DIM}),
+        embedding_bits bit({EMBEDDING_DIM})
+            GENERATED ALWAYS AS (binary_quantize(embedding)::bit({EMBEDDING_DIM})) STORED
     );
     """
     cur.execute(create_table_sql)
-    conn.commit()
 
-    print("Created fresh movie_embeddings table")
-    # Read JSON file
-    with open(json_file_path, "r", encoding="utf-8") as f:
-        movies = json.load(f)
+    # Cached answers refer to the old corpus, so start the cache over as well
+    cur.execute("DROP TABLE IF EXISTS answers_cache;")
+    create_cache_table_sql = f"""
+    CREATE TABLE answers_cache (
+        id SERIAL PRIMARY KEY,
+        embedding vector({EMBEDDING_DIM}),
+        question TEXT,
+        k INTEGER NOT NULL,
+        answer TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX ON answers_cache USING hnsw (embedding vector_cosine_ops);
+    CREATE INDEX ON answers_cache USING hash (question);
+    CREATE INDEX ON answers_cache (created_at);
+    """
+    cur.execute(create_cache_table_sql)
+    conn.commit()
 
-    # Process in batches
-    batch=[]
+    print("Created fresh movie_embeddings and answers_cache tables")
+    # Stream the JSON lines file (one movie per line) and process in batches
+    batch = []
     movie_texts = []
 
-    for idx, movie in enumerate(movies):
-        movie_id = movie.get("movie_id","")
-        title = movie.get("title","")
-        year = movie.get("year","")
-        genres = movie.get("genres",[])
-        plot_summary = movie.get("plot_summary","")
-        actors = movie.get("actors",[])
-
-        movie_text = f"Title: {title}. Year: {year}. Genres: {genres}. Plot: {plot_summary}. Starring: {actors}"
-        batch.append((movie_id, title, year, genres, plot_summary, actors))
-        movie_texts.append(movie_text)
-
-        if len(batch) == batch_size or idx == len(movies) - 1:
-            try:
-                response = client.embeddings.create(model="text-embedding-ada-002", input=movie_texts)
-                embeddings = [item.embedding for item in response.data]
-                # Prepare batch insert values
-                values = []
-                for (movie_id, title, year, genres, plot_summary, actors), embedding in zip(batch, embeddings):
-                    values.append((movie_id, title, year, genres, plot_summary, actors, embedding))
-                                # Batch insert using executemany
-                insert_sql = """
-                INSERT INTO movie_embeddings 
-                    (movie_id, title, year, genres, plot_summary, actors, embedding)
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
-                """
-                cur.executemany(insert_sql, values)
-                conn.commit()
-                print(f"Inserted {len(batch)} movies into movie_embeddings table")
+    with open(json_file_path, "rb") as f:
+        for line in f:
+            movie = orjson.loads(line)
+            movie_id = movie.get("movie_id","")
+            title = movie.get("title","")
+            year = movie.get("year","")
+            genres = movie.get("genres",[])
+            plot_summary = movie.get("plot_summary","")
+            actors = movie.get("actors",[])
+
+            movie_text = f"Title: {title}. Year: {year}. Genres: {genres}. Plot: {plot_summary}. Starring: {actors}"
+            batch.append((movie_id, title, year, genres, plot_summary, actors))
+            movie_texts.append(movie_text)
+
+            if len(batch) == batch_size:
+                insert_batch(conn, cur, batch, movie_texts)
                 batch = []
                 movie_texts = []
-            
-            except Exception as e:
-                print(f"Error inserting batch: {e}")
-                conn.rollback()
+
+    if batch:
+        insert_batch(conn, cur, batch, movie_texts)
+
+    # Build the ANN index after the bulk load, which is much faster than
+    # maintaining it row by row. Searches walk the 1-bit quantized vectors
+    # (32x smaller than float32) and rerank the candidates on the floats.
+    print("Building HNSW index on movie_embeddings")
+    cur.execute("""
+    CREATE INDEX ON movie_embeddings
+    USING hnsw (embedding_bits bit_hamming_ops) WITH (m = 16, ef_construction = 200);
+    """)
+    cur.execute("ANALYZE movie_embeddings;")
+    conn.commit()
 
     cur.close()
     conn.close()
@@ -101,5 +144,5 @@ def create_table_and_insert_data(json_file_path: str, batch_size: int = 20):
     print("Finished inserting data into movie_embeddings table")
 
 if __name__ == "__main__":
-    JSON_FILE_PATH = "movie_data.json"  # Update if needed
+    JSON_FILE_PATH = "movie_data.jsonl"  # Update if needed
     create_table_and_insert_data(JSON_FILE_PATH)
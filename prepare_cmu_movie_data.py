@@ -1,74 +1,100 @@
-import json
-import csv
-from collections import defaultdict
+import re
+import orjson
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pac
 from datetime import datetime
 
+# Values of the {"<freebase id>": "<genre>", ...} genre column; the keys are not needed
+_GENRE_RE = re.compile(r'":\s*"([^"]+)"')
+
 def read_plot_summaries(filename):
-    summaries = {}
+    """Yield (movie_id, summary) pairs one line at a time."""
     with open(filename, 'r') as f:
         for line in f:
             movie_id, script = line.split('\t')
-            summaries[movie_id] = script
-    return summaries
+            yield movie_id, script
+
+
+def _read_tsv(filename, columns):
+    """
+    Read the given {position: name} columns of a headerless TSV as strings with
+    pyarrow's multithreaded parser. Rows too short to hold every column are skipped.
+    """
+    include_columns = [f"f{i}" for i in columns]
+    table = pac.read_csv(
+        filename,
+        read_options=pac.ReadOptions(autogenerate_column_names=True),
+        parse_options=pac.ParseOptions(delimiter='\t', invalid_row_handler=lambda row: 'skip'),
+        convert_options=pac.ConvertOptions(
+            include_columns=include_columns,
+            column_types={name: pa.string() for name in include_columns}
+        )
+    )
+    return table.rename_columns(list(columns.values())).to_pandas()
 
 
 def read_movies_actors(filename):
-    movies_actors = defaultdict(set)
-    with open(filename, 'r') as f:
-        rows = csv.reader(f, delimiter='\t')
-        for row in rows:
-            if len(row) >=9:
-                movie_id = row[0]
-                actor_id = row[8]
-                if actor_id:
-                    movies_actors[movie_id].add(actor_id)
-    return movies_actors
+    """Return a Series mapping movie id to the set of its credited actor names."""
+    characters = _read_tsv(filename, {0: 'id', 8: 'actor'})
+    characters = characters[characters['actor'] != '']
+    return characters.groupby('id')['actor'].agg(set)
+
+
+def _parse_genres(genres_json):
+    # Escaped names (e.g. \u00e9) are rare, so only those pay for a full JSON decode
+    if '\\' in genres_json:
+        return list(orjson.loads(genres_json).values()) or None
+    return _GENRE_RE.findall(genres_json) or None
 
 
 def movie_metadata_read(filename):
-    movie_metadata = {}
-    with open(filename, 'r') as f:
-        rows = csv.reader(f, delimiter='\t')
-        for row in rows:
-            if len(row) >=8:
-                movie_id = row[0]
-                title = row[2]
-                year = row[3] if row[3] else None
-                genres = json.loads(row[8]) if row[8] else None
-                genres = list(genres.values()) if genres else None
-                movie_metadata[movie_id] = {'title': title, 'year': year, 'genres': genres}
-    return movie_metadata
+    """Return a DataFrame with the id, title, year and genre names of every movie."""
+    metadata = _read_tsv(filename, {0: 'id', 2: 'title', 3: 'year', 8: 'genres_json'})
+    metadata['genres'] = [_parse_genres(g) for g in metadata['genres_json']]
+    return metadata.drop(columns='genres_json')
 
 
 def consolidate_data(plot_summaries, movies_actors, movie_metadata, output_file):
-        plot_summaries = read_plot_summaries(plot_summaries)
-        movies_actors = read_movies_actors(movies_actors)
-        movie_metadata = movie_metadata_read(movie_metadata)
-        consolidated_data = []
-        for movie_id, summary in plot_summaries.items(): # iterate over the movie ids and summaries in plot_summaries::
-            if movie_id in movies_actors and movie_id in movie_metadata:
-                if movie_metadata[movie_id]['year']:        
-                    year = movie_metadata[movie_id]['year'][:4]
-                    if int(year) >= 2011 and len(list(movies_actors[movie_id])) >= 2:
-                        movie_data = {
-                            'movie_id': movie_id,   
-                            'title': movie_metadata[movie_id]['title'],
-                            'year': movie_metadata[movie_id]['year'],
-                            'genres': movie_metadata[movie_id]['genres'],
-                            'plot_summary': summary,
-                            'actors': list(movies_actors[movie_id])
-
-                        }
-                        consolidated_data.append(movie_data)
-        with open(output_file, 'w') as f:
-            json.dump(consolidated_data, f, indent=2)
-
-        print(f"Consolidated data saved to {output_file}\n with {len(consolidated_data)} movies")
+    """
+    Join the CMU files and write one JSON record per line to output_file.
+    Movies from 2011 on with at least two actors are selected with vectorized
+    filters and a hash join; summaries are then streamed and each record is
+    written as soon as it is built, so the corpus is never held in memory.
+    """
+    movies_actors = read_movies_actors(movies_actors)
+    movies_actors = movies_actors[movies_actors.map(len) >= 2].rename('actors')
+
+    movie_metadata = movie_metadata_read(movie_metadata)
+    release_year = pd.to_numeric(movie_metadata['year'].str.slice(0, 4), errors='coerce')
+    movie_metadata = movie_metadata[release_year >= 2011]
+
+    eligible = movie_metadata.join(movies_actors, on='id', how='inner')
+    eligible_movies = dict(zip(eligible['id'],
+                               eligible[['title', 'year', 'genres', 'actors']].itertuples(index=False)))
+
+    movie_count = 0
+    with open(output_file, 'wb') as f:
+        for movie_id, summary in read_plot_summaries(plot_summaries):
+            movie = eligible_movies.get(movie_id)
+            if movie is not None:
+                movie_data = {
+                    'movie_id': movie_id,
+                    'title': movie.title,
+                    'year': movie.year,
+                    'genres': movie.genres,
+                    'plot_summary': summary,
+                    'actors': list(movie.actors)
+                }
+                f.write(orjson.dumps(movie_data) + b"\n")
+                movie_count += 1
+
+    print(f"Consolidated data saved to {output_file}\n with {movie_count} movies")
 
 if __name__ == '__main__':
     plot_file = "MovieSummaries/plot_summaries.txt"
     character_file = "MovieSummaries/character.metadata.tsv"
     movie_metadata_file = "MovieSummaries/movie.metadata.tsv"
-    output_file = "movie_data.json"
+    output_file = "movie_data.jsonl"
 
     consolidate_data(plot_file, character_file, movie_metadata_file, output_file)
\ No newline at end of file
@@ -1,18 +1,52 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional
 import uvicorn
-from test_vectordb import ask_question
+from test_vectordb import (
+    ANSWER_CACHE_TTL_SECONDS,
+    MAX_K,
+    ask_question,
+    ask_question_stream,
+    create_pool,
+    load_embedding_matrix,
+    prune_answers_cache,
+    wait_for_cache_writes,
+)
+
+async def prune_answers_cache_periodically(pool):
+    """Keep the semantic answer cache from growing past its TTL."""
+    while True:
+        await asyncio.sleep(ANSWER_CACHE_TTL_SECONDS)
+        try:
+            await prune_answers_cache(pool)
+        except Exception as e:
+            print(f"Error pruning answers cache: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One connection pool shared by every request for the lifetime of the app
+    app.state.pool = await create_pool()
+    await load_embedding_matrix(app.state.pool)
+    prune_task = asyncio.create_task(prune_answers_cache_periodically(app.state.pool))
+    yield
+    prune_task.cancel()
+    await wait_for_cache_writes()
+    await app.state.pool.close()
 
 app = FastAPI(
     title="CMU Movie RAG API",
     description="API for querying movie information using RAG (Retrieval Augmented Generation)",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 class Question(BaseModel):
     text: str
-    k: Optional[int] = 10
+    k: Optional[int] = Field(10, ge=1, le=MAX_K)
 
 class MovieInfo(BaseModel):
     title: Optional[str] = ""
@@ -31,10 +65,10 @@ class Answer(BaseModel):
     answer: str
 
 @app.post("/rag", response_model=Answer)
-async def rag(question: Question):
+async def rag(question: Question, request: Request):
     try:
         # Get answer and retrieved movies using the modified ask_question function
-        answer, retrieved_movies = ask_question(question.text, k=question.k)
+        answer, retrieved_movies = await ask_question(request.app.state.pool, question.text, k=question.k)
         
         # Ensure all fields are strings, replace None with empty string
         cleaned_movies = []
@@ -60,6 +94,29 @@ async def rag(question: Question):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def answer_events(tokens):
+    """Frame each answer token as a server-sent event."""
+    try:
+        async for token in tokens:
+            yield f"data: {json.dumps(token)}\n\n"
+    except Exception as e:
+        # The 200 status has already been sent, so report the failure in-band
+        yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+    finally:
+        # Close the token iterator right away on disconnect instead of leaving
+        # the upstream completion stream open until garbage collection
+        await tokens.aclose()
+
+@app.post("/rag/stream")
+async def rag_stream(question: Question, request: Request):
+    # Streams the answer as it is generated; /rag keeps returning the full answer as JSON
+    try:
+        tokens = await ask_question_stream(request.app.state.pool, question.text, k=question.k)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return StreamingResponse(answer_events(tokens), media_type="text/event-stream")
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
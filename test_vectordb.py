@@ -1,12 +1,16 @@
 import os
-from openai import OpenAI
-import psycopg2
+import asyncio
+import hashlib
+from collections import OrderedDict
+import asyncpg
+from pgvector.asyncpg import register_vector
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import numpy as np
 
 load_dotenv()
 
-client = OpenAI()
+client = AsyncOpenAI()
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
@@ -14,136 +18,456 @@ DB_NAME = os.getenv("DB_NAME", "movies_db")
 DB_USER = os.getenv("DB_USER", "manishsingh")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "manish123")
 
-EMBEDDING_DIM = 1536
+# Must match the model and dimensions insert_data_vectordb.py embedded the corpus with
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 512
 
-def get_top_k_context(question: str, k: int = 10):
+# Semantic answer cache: a cached answer is reused when a new question asks for
+# the same k and its embedding is within this cosine distance of a previously
+# answered one.
+ANSWER_CACHE_MAX_DISTANCE = 0.08
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# Answer-cache INSERTs still running in the background
+_cache_writes = set()
 
-    response = client.embeddings.create(
-        model="text-embedding-ada-002",
-        input=question,
-    )
+# Exact-match question -> embedding cache. Values are futures so concurrent
+# requests for the same text share a single in-flight embeddings call.
+EMBEDDING_CACHE_SIZE = 4096
+_embedding_cache = OrderedDict()
+
+# Corpora up to this size are searched with an in-memory matrix product instead
+# of pgvector, which stays the source of truth. float32 rather than float16
+# because NumPy only dispatches float32/float64 matmuls to BLAS.
+IN_MEMORY_MAX_ROWS = 200_000
+_movie_ids = None
+_movie_matrix = None
+
+# Retrieved movies scoring at or below this 1 / (1 + distance) are left out of the prompt
+SIMILARITY_THRESHOLD = 0.3
+
+# Plot summaries and cast lists are cut down in SQL, before they cross the wire
+PLOT_SUMMARY_MAX_CHARS = 600
+MAX_ACTORS = 6
+
+# Only the columns build_messages and ask_question use
+MOVIE_COLUMNS_SQL = f"""
+    m.title, m.year, m.genres,
+    left(m.plot_summary, {PLOT_SUMMARY_MAX_CHARS}) AS plot_summary,
+    array_to_string((m.actors::text[])[1:{MAX_ACTORS}], ', ') AS actors"""
+
+# Sent unchanged as the system message of every request so it forms a stable
+# prefix for OpenAI's prompt caching. Kept flush-left so no indentation is sent.
+STATIC_INSTRUCTIONS = """You are a helpful movie recommendation assistant. Using ONLY the information provided below, answer the following question.
+For each movie you mention, include:
+1. Title and year
+2. Genres
+3. A brief explanation of why this movie is relevant to the question
+
+When recommending similar movies, consider:
+- Similar genres
+- Similar themes in the plot
+- Similar time period
+- Similar style or tone
+- Similar actors
+
+If a movie's similarity score is provided, use it to rank the recommendations, but focus more on explaining WHY the movies are similar.
+If you don't have enough relevant information, explain what aspects you were able to find matches for."""
+
+# Number of binary-quantized candidates reranked with the full float vectors
+RERANK_CANDIDATES = 200
+
+# Size of the HNSW candidate list explored per search. It caps how many rows
+# an index scan can return, so it must cover RERANK_CANDIDATES, and k when k is
+# larger. pgvector rejects values above 1000, which bounds k as well.
+HNSW_EF_SEARCH = RERANK_CANDIDATES
+HNSW_MAX_EF_SEARCH = 1000
+MAX_K = HNSW_MAX_EF_SEARCH
+
+# Keep KNN queries on the HNSW index scan; a bitmap heap scan loses the ordering
+SEARCH_SETTINGS_SQL = """
+SET LOCAL enable_bitmapscan = off;
+SET LOCAL hnsw.ef_search = {ef_search};
+"""
+
+# Two-stage search: the HNSW index over the 1-bit quantized embeddings picks
+# candidates by Hamming distance, then only those are reranked by negative
+# inner product on the float vectors, and only the K survivors are joined back
+# for their text columns. For unit-length embeddings the L2 distance is
+# sqrt(2 - 2 * inner product).
+SEARCH_SQL = f"""
+WITH candidates AS (
+    SELECT id, embedding <#> $1::vector AS neg_inner_product
+    FROM movie_embeddings
+    ORDER BY embedding_bits <~> binary_quantize($1::vector)::bit({EMBEDDING_DIM})
+    LIMIT greatest({RERANK_CANDIDATES}, $2)
+), top_k AS (
+    SELECT id, neg_inner_product
+    FROM candidates
+    ORDER BY neg_inner_product
+    LIMIT $2
+)
+SELECT{MOVIE_COLUMNS_SQL},
+    sqrt(greatest(2 + 2 * t.neg_inner_product, 0)) AS distance
+FROM top_k t
+JOIN movie_embeddings m USING (id)
+ORDER BY t.neg_inner_product;
+"""
+
+# Fetch the rows picked by the in-memory search, keeping their rank and distance
+FETCH_BY_ID_SQL = f"""
+SELECT{MOVIE_COLUMNS_SQL},
+    t.distance
+FROM unnest($1::int[], $2::float8[]) WITH ORDINALITY AS t(id, distance, rank)
+JOIN movie_embeddings m USING (id)
+ORDER BY t.rank;
+"""
+
+EXACT_CACHE_LOOKUP_SQL = """
+SELECT answer
+FROM answers_cache
+WHERE question = $1
+  AND k = $2
+  AND created_at > now() - make_interval(secs => $3)
+ORDER BY created_at DESC
+LIMIT 1;
+"""
+
+CACHE_LOOKUP_SQL = """
+SELECT answer
+FROM answers_cache
+WHERE embedding <=> $1::vector < $2
+  AND k = $3
+  AND created_at > now() - make_interval(secs => $4)
+ORDER BY embedding <=> $1::vector
+LIMIT 1;
+"""
+
+CACHE_INSERT_SQL = """
+INSERT INTO answers_cache (embedding, question, k, answer)
+VALUES ($1::vector, $2, $3, $4);
+"""
 
-    question_embedding = response.data[0].embedding
-    embedding_string = f"[{','.join(map(str, question_embedding))}]"
+CACHE_PRUNE_SQL = """
+DELETE FROM answers_cache
+WHERE created_at < now() - make_interval(secs => $1);
+"""
 
-    conn = psycopg2.connect(
+async def _init_connection(conn):
+    """Send and receive pgvector values in their binary format."""
+    await register_vector(conn)
+
+async def create_pool():
+    """
+    Create the asyncpg pool used for all vector searches. asyncpg prepares and
+    caches statements per connection, so the search SQL is only planned once.
+    """
+    return await asyncpg.create_pool(
         host=DB_HOST,
         port=DB_PORT,
-        dbname=DB_NAME,
+        database=DB_NAME,
         user=DB_USER,
-        password=DB_PASSWORD
+        password=DB_PASSWORD,
+        min_size=2,
+        max_size=16,
+        init=_init_connection
     )
-    cur = conn.cursor()
-
-    search_sql = """
-    SELECT
-        movie_id,
-        title,
-        year,
-        genres,
-        plot_summary,
-        actors,
-        embedding <-> %s::vector AS distance
-    FROM movie_embeddings
-    ORDER BY embedding <-> %s::vector
-    LIMIT %s;
+
+async def _fetch_embedding(text: str):
+    response = await client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=text,
+        dimensions=EMBEDDING_DIM,
+    )
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+def _forget_failed_embedding(key, future):
+    if (future.cancelled() or future.exception() is not None) and _embedding_cache.get(key) is future:
+        del _embedding_cache[key]
+
+async def embed(text: str):
+    """
+    Embed text, reusing the result for identical strings. The cache is only
+    touched between awaits, so no lock is needed on the event loop.
     """
+    key = hashlib.blake2b(text.encode()).digest()
+    future = _embedding_cache.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_fetch_embedding(text))
+        future.add_done_callback(lambda f: _forget_failed_embedding(key, f))
+        _embedding_cache[key] = future
+        if len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+    else:
+        _embedding_cache.move_to_end(key)
+
+    # Shield so a cancelled caller does not cancel the call other callers await
+    return await asyncio.shield(future)
+
+async def load_embedding_matrix(pool):
+    """
+    Load every movie embedding into memory if the corpus has at most
+    IN_MEMORY_MAX_ROWS rows, so get_top_k_context can rank with one matrix
+    product. The matrix is a snapshot; restart after re-ingesting the corpus.
+    """
+    global _movie_ids, _movie_matrix
+
+    async with pool.acquire() as conn:
+        row_count = await conn.fetchval("SELECT count(*) FROM movie_embeddings")
+        if row_count == 0 or row_count > IN_MEMORY_MAX_ROWS:
+            return
+        rows = await conn.fetch("SELECT id, embedding FROM movie_embeddings")
+
+    # The pgvector codec decodes vector columns to pgvector.Vector objects
+    matrix = np.vstack([row["embedding"].to_numpy() for row in rows]).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    _movie_ids = np.fromiter((row["id"] for row in rows), dtype=np.int64, count=len(rows))
+    _movie_matrix = matrix
+    print(f"Loaded {len(rows)} movie embeddings for in-memory search")
+
+def _score_in_memory(question_embedding, k: int):
+    """Return the row indices of the k nearest movies and their L2 distances."""
+    similarities = _movie_matrix @ question_embedding
+    top = np.argpartition(-similarities, k - 1)[:k]
+    top = top[np.argsort(-similarities[top])]
+    # Same L2 distance the SQL search reports for unit-length vectors
+    distances = np.sqrt(np.maximum(2 - 2 * similarities[top], 0))
+    return top, distances
+
+async def _top_k_in_memory(pool, question_embedding, k: int):
+    k = min(k, len(_movie_ids))
+    if k <= 0:
+        return []
 
-    cur.execute(search_sql, (embedding_string, embedding_string, k))
-    results = cur.fetchall()
+    # Tens of milliseconds near IN_MEMORY_MAX_ROWS; NumPy releases the GIL, so
+    # a worker thread keeps the event loop serving other requests meanwhile
+    top, distances = await asyncio.to_thread(_score_in_memory, question_embedding, k)
+
+    async with pool.acquire() as conn:
+        return await conn.fetch(FETCH_BY_ID_SQL, _movie_ids[top].tolist(), distances.tolist())
+
+async def get_top_k_context(pool, question_embedding, k: int = 10):
+
+    if _movie_matrix is not None:
+        return await _top_k_in_memory(pool, question_embedding, k)
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            ef_search = min(max(HNSW_EF_SEARCH, k), HNSW_MAX_EF_SEARCH)
+            await conn.execute(SEARCH_SETTINGS_SQL.format(ef_search=ef_search))
+            results = await conn.fetch(SEARCH_SQL, question_embedding, k)
 
-    cur.close()
-    conn.close()
     return results
 
-def build_prompt(question: str, top_results):
+async def lookup_exact_cached_answer(pool, question: str, k: int):
+    """Return a fresh cached answer for exactly this question text and k, or None."""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(EXACT_CACHE_LOOKUP_SQL, question, k, ANSWER_CACHE_TTL_SECONDS)
+
+async def lookup_cached_answer(pool, question_embedding, k: int):
+    """Return a fresh cached answer for a semantically equivalent question with the same k, or None."""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            CACHE_LOOKUP_SQL,
+            question_embedding,
+            ANSWER_CACHE_MAX_DISTANCE,
+            k,
+            ANSWER_CACHE_TTL_SECONDS
+        )
+
+async def cache_answer(pool, question_embedding, question: str, k: int, answer: str):
+    async with pool.acquire() as conn:
+        await conn.execute(CACHE_INSERT_SQL, question_embedding, question, k, answer)
+
+async def _cache_answer_or_log(pool, question_embedding, question: str, k: int, answer: str):
+    try:
+        await cache_answer(pool, question_embedding, question, k, answer)
+    except Exception as e:
+        print(f"Error caching answer: {e}")
+
+def schedule_cache_answer(pool, question_embedding, question: str, k: int, answer: str):
     """
-    Builds a prompt that includes the user question plus the context from top_results.
+    Write an answer to the cache in the background, so the INSERT neither
+    delays the response nor fails the request.
     """
+    task = asyncio.create_task(_cache_answer_or_log(pool, question_embedding, question, k, answer))
+    # The event loop only keeps weak references to tasks
+    _cache_writes.add(task)
+    task.add_done_callback(_cache_writes.discard)
+
+async def wait_for_cache_writes():
+    """Wait for pending cache writes; call before closing the pool."""
+    await asyncio.gather(*_cache_writes)
+
+async def prune_answers_cache(pool):
+    """Delete cached answers older than ANSWER_CACHE_TTL_SECONDS."""
+    async with pool.acquire() as conn:
+        await conn.execute(CACHE_PRUNE_SQL, ANSWER_CACHE_TTL_SECONDS)
+
+def similarity_scores(rows):
+    """Convert the distance column of the retrieved rows into 1 / (1 + distance) scores."""
+    distances = np.fromiter((row["distance"] for row in rows), dtype=np.float32, count=len(rows))
+    return 1.0 / (1.0 + distances)
+
+def build_messages(question: str, top_results):
+    """
+    Builds the chat messages: the static instructions as the system message, and
+    the context from top_results plus the user question as the user message.
+    """
+    scores = similarity_scores(top_results)
+    # Using a lower threshold to include more relevant matches
+    selected = np.flatnonzero(scores > SIMILARITY_THRESHOLD)
+
     context_texts = []
-    for r in top_results:
-        movie_id, title, year, genres, plot_summary, actors, distance = r
-        similarity_score = 1 / (1 + distance)
-        # Using a lower threshold to include more relevant matches
-        if similarity_score > 0.3:  
-            snippet = f"""
-            Title: {title}
-            Year: {year}
-            Genres: {genres}
-            Plot: {plot_summary}
-            Actors: {actors}
-            Similarity Score: {similarity_score:.3f}
-            """
-            context_texts.append(snippet.strip())
+    for i in selected:
+        title, year, genres, plot_summary, actors, distance = top_results[i]
+        context_texts.append(
+            f"Title: {title}\n"
+            f"Year: {year}\n"
+            f"Genres: {genres}\n"
+            f"Plot: {plot_summary}\n"
+            f"Actors: {actors}\n"
+            f"Similarity Score: {scores[i]:.3f}"
+        )
 
     context_block = "\n\n".join(context_texts)
 
-    prompt = f"""
-    You are a helpful movie recommendation assistant. Using ONLY the information provided below, answer the following question.
-    For each movie you mention, include:
-    1. Title and year
-    2. Genres
-    3. A brief explanation of why this movie is relevant to the question
-
-    When recommending similar movies, consider:
-    - Similar genres
-    - Similar themes in the plot
-    - Similar time period
-    - Similar style or tone
-    - Similar actors
-    
-    If a movie's similarity score is provided, use it to rank the recommendations, but focus more on explaining WHY the movies are similar.
-    If you don't have enough relevant information, explain what aspects you were able to find matches for.
-
-    Movie Information:
-    {context_block}
+    return [
+        {"role": "system", "content": STATIC_INSTRUCTIONS},
+        {"role": "user", "content": f"Movie Information:\n{context_block}\n\nQuestion: {question}"}
+    ]
 
-    Question: {question}
+async def _cached_answer_or_context(pool, question: str, k: int):
     """
-    return prompt
+    Returns (question_embedding, cached_answer, rows). When the same or a
+    semantically equivalent question was answered recently, rows is empty and
+    the cached answer is returned (question_embedding is None on an exact text
+    match); otherwise cached_answer is None and rows
+    holds the top-k context.
+    """
+    # The exact-match lookup needs no embedding, so start the embedding call
+    # alongside it but only wait for it on a miss. Cancelling the task on a hit
+    # never cancels an embeddings call already in flight; that call is shielded
+    # and still fills the embedding cache.
+    embedding_task = asyncio.create_task(embed(question))
+    try:
+        cached_answer = await lookup_exact_cached_answer(pool, question, k)
+    except BaseException:
+        embedding_task.cancel()
+        raise
+    if cached_answer is not None:
+        embedding_task.cancel()
+        return None, cached_answer, []
+
+    question_embedding = await embedding_task
+
+    # Speculatively fetch the context while checking the semantic cache; the
+    # rows are simply dropped on a cache hit
+    cached_answer, rows = await asyncio.gather(
+        lookup_cached_answer(pool, question_embedding, k),
+        get_top_k_context(pool, question_embedding, k=k)
+    )
+    if cached_answer is not None:
+        return question_embedding, cached_answer, []
+
+    return question_embedding, None, rows
 
-def ask_question(question: str, k: int = 10):
+async def ask_question(pool, question: str, k: int = 10):
     """
     Ask a question about movies and get both the answer and the retrieved context.
     
     Args:
+        pool: asyncpg pool created by create_pool()
         question (str): The question to ask
         k (int): Number of similar movies to retrieve
         
     Returns:
         tuple: (answer, retrieved_movies) where answer is the LLM's response and
-               retrieved_movies is a list of movie dictionaries
+               retrieved_movies is a list of movie dictionaries (empty when the
+               answer was served from the semantic cache)
     """
-    # 1. Retrieve top-k context rows
-    rows = get_top_k_context(question, k=k)
+    # 1. Reuse a cached answer if we have one, otherwise retrieve top-k context rows
+    question_embedding, cached_answer, rows = await _cached_answer_or_context(pool, question, k)
+    if cached_answer is not None:
+        return cached_answer, []
 
-    # 2. Build prompt for LLM
-    prompt = build_prompt(question, rows)
+    # 2. Build messages for LLM
+    messages = build_messages(question, rows)
 
-    # 3. Call OpenAI with the final prompt
-    response = client.chat.completions.create(
+    # 3. Call OpenAI with the final messages
+    response = await client.chat.completions.create(
         model="gpt-4o-mini",temperature=0,
-        messages=[{"role": "user", "content": prompt}]
+        messages=messages
     )
     answer = response.choices[0].message.content
+    # Never cache a missing answer; it would be served to every later match
+    if answer:
+        schedule_cache_answer(pool, question_embedding, question, k, answer)
 
     # 4. Format retrieved movies
     retrieved_movies = []
-    for row in rows:
-        movie_id, title, year, genres, plot_summary, actors, distance = row
+    for row, similarity_score in zip(rows, similarity_scores(rows).tolist()):
+        title, year, genres, plot_summary, actors, distance = row
         retrieved_movies.append({
             "title": title,
             "year": year,
             "genres": genres,
             "plot_summary": plot_summary,
             "actors": actors,
-            "similarity_score": 1 / (1 + distance)
+            "similarity_score": similarity_score
         })
 
     return answer, retrieved_movies
 
-if __name__ == "__main__":
+async def _cached_answer_tokens(answer: str):
+    yield answer
+
+async def _answer_tokens(pool, stream, question_embedding, question: str, k: int):
+    answer_parts = []
+    # Closing the stream releases the upstream connection when the caller stops
+    # iterating early (e.g. the client disconnected), not only at the last chunk
+    async with stream:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                answer_parts.append(token)
+                yield token
+
+    # Only cache non-empty answers the client received in full
+    if answer_parts:
+        schedule_cache_answer(pool, question_embedding, question, k, "".join(answer_parts))
+
+async def ask_question_stream(pool, question: str, k: int = 10):
+    """
+    Like ask_question, but returns an async iterator over the answer text as the
+    LLM generates it so callers can forward tokens before the completion has
+    finished. Cache lookup, retrieval and opening the completion stream all
+    happen before this returns, so their errors surface to the caller here
+    rather than partway through the iteration.
+    """
+    question_embedding, cached_answer, rows = await _cached_answer_or_context(pool, question, k)
+    if cached_answer is not None:
+        return _cached_answer_tokens(cached_answer)
+
+    messages = build_messages(question, rows)
+    stream = await client.chat.completions.create(
+        model="gpt-4o-mini",temperature=0,
+        messages=messages,
+        stream=True
+    )
+    return _answer_tokens(pool, stream, question_embedding, question, k)
+
+async def main():
     user_question = input("What is your question about the movies?")
-    answer, movies = ask_question(user_question, k=10)
+    pool = await create_pool()
+    try:
+        answer, movies = await ask_question(pool, user_question, k=10)
+    finally:
+        await wait_for_cache_writes()
+        await pool.close()
     print("----- LLM ANSWER -----")
-    print(answer)
\ No newline at end of file
+    print(answer)
+
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file